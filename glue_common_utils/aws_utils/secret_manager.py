@@ -1,25 +1,169 @@
 import base64
+import copy
 import json
+import threading
+import time
 import boto3
 import logging
 
-logging.basicConfig(level=logging.INFO)
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # optional, faster JSON decoding
+    _json_loads = json.loads
+
+try:
+    from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
+except ImportError:  # optional, falls back to plain GetSecretValue calls
+    SecretCache = None
+
 logger = logging.getLogger(__name__)
 
+# boto3 clients are reused per region, building one resolves credentials and endpoints
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(aws_region):
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(aws_region)
+        if client is None:
+            client = boto3.client('secretsmanager', region_name=aws_region)
+            _CLIENTS[aws_region] = client
+        return client
+
+
 class SecretManager:
+    # in-process cache: (aws_region, secret_name) -> (expiry, decoded secret)
+    # shared by all callers, so values are deep-copied on the way in and out
+    _CACHE = {}
+    _TTL = 300
+    _LOCK = threading.Lock()
+    # one aws_secretsmanager_caching.SecretCache per region, shared by all instances
+    _SECRET_CACHES = {}
+    _SECRET_REFRESH_INTERVAL = 3600
+    # invalidated secrets: (aws_region, secret_name) -> monotonic time until which the
+    # SecretCache copy may still be stale and reads go to GetSecretValue directly
+    _BYPASS = {}
+    # BatchGetSecretValue accepts at most 20 ids per call
+    _BATCH_SIZE = 20
+
     def __init__(self, aws_region="cn-north-1"):
         self.aws_region = aws_region
-        self.client = boto3.client('secretsmanager', region_name=aws_region)
+        self.client = _get_client(aws_region)
+        self._secret_cache = self._get_secret_cache()
+
+    def _get_secret_cache(self):
+        if SecretCache is None:
+            return None
+        with self._LOCK:
+            secret_cache = self._SECRET_CACHES.get(self.aws_region)
+            if secret_cache is None:
+                config = SecretCacheConfig(max_cache_size=64, secret_refresh_interval=self._SECRET_REFRESH_INTERVAL)
+                secret_cache = SecretCache(config=config, client=self.client)
+                self._SECRET_CACHES[self.aws_region] = secret_cache
+            return secret_cache
+
     def get_secret(self, secret_name):
+        key = (self.aws_region, secret_name)
+        now = time.monotonic()
+        with self._LOCK:
+            cached = self._CACHE.get(key)
+            if cached is not None and now < cached[0]:
+                return copy.deepcopy(cached[1])
+
         try:
-            response = self.client.get_secret_value(SecretId=secret_name)
+            secret_string, secret_binary = self._fetch_secret(secret_name)
         except Exception as e:
             logger.error(f"get salesforce credential from AWS Secret Manager - Secret: {secret_name} error")
-            logger.error("detail error massages: {e}")
+            logger.error("detail error massages: %s", e)
             raise
-        if 'SecretString' in response:
-            credential = json.loads(response['SecretString'])
-            return credential
-        else:
-            credential = base64.b64decode(response['SecretBinary'])
-            return json.loads(credential)
+        credential = self._decode(secret_string, secret_binary)
+
+        with self._LOCK:
+            self._CACHE[key] = (now + self._TTL, copy.deepcopy(credential))
+        return credential
+
+    def get_secrets(self, secret_names):
+        """Fetch several secrets with BatchGetSecretValue, returns {secret_name: secret}."""
+        now = time.monotonic()
+        secrets = {}
+        missing = []
+        with self._LOCK:
+            for secret_name in dict.fromkeys(secret_names):
+                cached = self._CACHE.get((self.aws_region, secret_name))
+                if cached is not None and now < cached[0]:
+                    secrets[secret_name] = copy.deepcopy(cached[1])
+                else:
+                    missing.append(secret_name)
+
+        for i in range(0, len(missing), self._BATCH_SIZE):
+            chunk = missing[i:i + self._BATCH_SIZE]
+            try:
+                response = self.client.batch_get_secret_value(SecretIdList=chunk)
+            except Exception as e:
+                logger.error(f"batch get secrets from AWS Secret Manager - Secrets: {chunk} error")
+                logger.error("detail error massages: %s", e)
+                raise
+            if response.get('Errors'):
+                failed = [error['SecretId'] for error in response['Errors']]
+                raise RuntimeError(f"batch get secrets from AWS Secret Manager - Secrets: {failed} error")
+
+            for value in response['SecretValues']:
+                secret_name = self._requested_id(chunk, value)
+                secrets[secret_name] = self._decode(value.get('SecretString'), value.get('SecretBinary'))
+            unmatched = [secret_name for secret_name in chunk if secret_name not in secrets]
+            if unmatched:
+                raise RuntimeError(f"batch get secrets from AWS Secret Manager - Secrets: {unmatched} not returned")
+            with self._LOCK:
+                for secret_name in chunk:
+                    self._CACHE[(self.aws_region, secret_name)] = (now + self._TTL, copy.deepcopy(secrets[secret_name]))
+        return secrets
+
+    @staticmethod
+    def _requested_id(secret_ids, value):
+        """Map a SecretValues entry back to the id the caller passed: name, full ARN or partial ARN."""
+        for secret_id in secret_ids:
+            if secret_id in (value['Name'], value['ARN']):
+                return secret_id
+        for secret_id in secret_ids:
+            # a partial ARN omits exactly the "-XXXXXX" suffix Secrets Manager appends to the full ARN
+            if len(value['ARN']) == len(secret_id) + 7 and value['ARN'].startswith(secret_id + '-'):
+                return secret_id
+        raise RuntimeError(f"batch get secrets from AWS Secret Manager - "
+                           f"Secret: {value['ARN']} does not match any requested id")
+
+    @staticmethod
+    def _decode(secret_string, secret_binary):
+        if secret_string is not None:
+            return _json_loads(secret_string)
+        return _json_loads(base64.b64decode(secret_binary))
+
+    def _fetch_secret(self, secret_name):
+        """Return (SecretString, SecretBinary) of the current version, one of them None."""
+        if self._secret_cache is not None and not self._bypass_secret_cache(secret_name):
+            secret_string = self._secret_cache.get_secret_string(secret_name)
+            if secret_string is not None:
+                return secret_string, None
+            return None, self._secret_cache.get_secret_binary(secret_name)
+        response = self.client.get_secret_value(SecretId=secret_name)
+        return response.get('SecretString'), response.get('SecretBinary')
+
+    def _bypass_secret_cache(self, secret_name):
+        key = (self.aws_region, secret_name)
+        with self._LOCK:
+            deadline = self._BYPASS.get(key)
+            if deadline is not None and time.monotonic() >= deadline:
+                del self._BYPASS[key]
+                deadline = None
+        return deadline is not None
+
+    def invalidate(self, secret_name):
+        """Drop the cached value, e.g. after the secret has been rotated. Does not call AWS."""
+        key = (self.aws_region, secret_name)
+        with self._LOCK:
+            self._CACHE.pop(key, None)
+            if self._secret_cache is not None:
+                # SecretCache.refresh_secret_now sleeps for seconds and refreshes synchronously;
+                # instead skip SecretCache until its own refresh interval has replaced the old value
+                self._BYPASS[key] = time.monotonic() + self._SECRET_REFRESH_INTERVAL
@@ -1,16 +1,363 @@
+import csv
+import functools
+import io
+import itertools
 import logging
-from simple_salesforce import Salesforce
+import operator
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, select_proxy
+from simple_salesforce import Salesforce, SalesforceExpiredSession
+from urllib3.util.retry import Retry
 from glue_common_utils.aws_utils.secret_manager import SecretManager
 
-logging.basicConfig(level=logging.INFO)
+try:
+    import orjson
+except ImportError:  # 可选依赖，未安装时使用simple_salesforce默认的json解析
+    orjson = None
+
+try:
+    import httpx
+except ImportError:  # 可选依赖，仅http2=True时需要(pip install httpx[http2])
+    httpx = None
+
 logger = logging.getLogger(__name__)
 
+# 已登录的Salesforce连接，按credential_secret复用，避免同一作业内重复登录
+# (credential_secret, http2) -> (sf, login_time)
+_SF_CONNECTIONS = {}
+# 略短于Salesforce默认的30分钟会话超时
+_SESSION_TTL = 25 * 60
+# 连接池大小需覆盖分页预取的并发数
+_HTTP_POOL_SIZE = 32
+# nextRecordsUrl: /services/data/vXX.X/query/<locator>-<offset>
+_LOCATOR_RE = re.compile(r'^(?P<prefix>.+-)(?P<offset>\d+)$')
+_SELECT_KEYWORD_RE = re.compile(r'^\s*SELECT\s', re.IGNORECASE)
+_SOBJECT_RE = re.compile(r'\s+(?P<sobject>\w+)')
+_FIELD_NAME_RE = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)*$')
+_POP_ATTRIBUTES = operator.methodcaller('pop', 'attributes', None)
+
+# 子句关键字的匹配会先吃掉字符串字面量和括号（子查询），避免匹配到其中的FROM/ORDER BY等
+_SKIPPED_RE = r"'(?:[^'\\]|\\.)*'|\((?:[^()']|'(?:[^'\\]|\\.)*'|\([^()]*\))*\)"
+_FROM_RE = re.compile(rf"{_SKIPPED_RE}|\b(?P<clause>FROM)\b", re.IGNORECASE)
+_COUNT_STRIP_RE = re.compile(rf"{_SKIPPED_RE}|\b(?P<clause>ORDER\s+BY|LIMIT|OFFSET|GROUP\s+BY|HAVING)\b",
+                             re.IGNORECASE)
+_WHERE_RE = re.compile(rf"{_SKIPPED_RE}|\b(?P<clause>WHERE)\b", re.IGNORECASE)
+_ORDER_BY_RE = re.compile(rf"{_SKIPPED_RE}|\b(?P<clause>ORDER\s+BY)\b", re.IGNORECASE)
+# WHERE条件之后的子句：WITH, GROUP BY, HAVING, ORDER BY, LIMIT, OFFSET, FOR VIEW/REFERENCE/UPDATE, UPDATE TRACKING
+_CONDITION_END_RE = re.compile(
+    rf"{_SKIPPED_RE}|\b(?P<clause>WITH|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|OFFSET|FOR|UPDATE)\b", re.IGNORECASE)
+_KEYSET_UNSUPPORTED_RE = re.compile(
+    rf"{_SKIPPED_RE}|\b(?P<clause>GROUP\s+BY|HAVING|LIMIT|OFFSET|FOR|UPDATE)\b", re.IGNORECASE)
+_FIELD_SEPARATOR_RE = re.compile(rf"{_SKIPPED_RE}|(?P<clause>,)")
+
+
+def _reauth_on_expired_session(func):
+    """
+    会话过期(INVALID_SESSION_ID)时重新登录并整体重跑一次方法
+
+    只用于没有回调、整体重跑没有副作用的方法；分页/分批路径用SalesforceConnector._sf_call只重试失败的那个请求。
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except SalesforceExpiredSession:
+            logger.warning("Salesforce session expired, reconnecting...")
+            self.connect(force=True)
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class _OrjsonSalesforce(Salesforce):
+    """REST响应直接用orjson从bytes解析，query/query_more/query_all都经由parse_result_to_json"""
+
+    def parse_result_to_json(self, result):
+        return orjson.loads(result.content)
+
+
+_SalesforceClient = _OrjsonSalesforce if orjson is not None else Salesforce
+
+
+def _configure_http_session(session):
+    """增大连接池以复用keep-alive连接，并对限流(429)和5xx响应自动退避重试"""
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=_HTTP_POOL_SIZE, pool_maxsize=_HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+class _HttpxAdapter(BaseAdapter):
+    """
+    通过httpx的HTTP/2客户端发送requests请求
+
+    挂载到simple_salesforce的requests.Session上，并发预取的分页请求在同一个TCP连接上多路复用，
+    响应按gzip压缩传输后由httpx解压。
+
+    verify/cert/proxies按requests的语义转发，每种组合对应一个httpx客户端（通常只有一个）。
+    stream=True时响应体同样一次读完，bulk2等调用方的iter_content从内存中分块读取。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def _get_client(self, verify, cert, proxy):
+        key = (verify, cert, proxy)
+        with self._clients_lock:
+            client = self._clients.get(key)
+            if client is None:
+                transport = httpx.HTTPTransport(http2=True, retries=3, verify=verify, cert=cert, proxy=proxy)
+                client = httpx.Client(http2=True, transport=transport)
+                self._clients[key] = client
+            return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+            timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        client = self._get_client(verify, cert, select_proxy(request.url, proxies))
+        try:
+            response = client.request(request.method, request.url, headers=dict(request.headers),
+                                      content=request.body, timeout=timeout)
+        except httpx.ConnectTimeout as e:
+            raise requests.ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            raise requests.ReadTimeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e, request=request)
+
+        result = requests.Response()
+        result.status_code = response.status_code
+        result.reason = response.reason_phrase
+        result.headers = CaseInsensitiveDict(response.headers)
+        result.encoding = get_encoding_from_headers(result.headers)
+        result._content = response.content
+        result._content_consumed = True
+        result.raw = io.BytesIO(response.content)
+        result.url = request.url
+        result.request = request
+        result.connection = self
+        result.elapsed = response.elapsed
+        return result
+
+    def close(self):
+        with self._clients_lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+def _search_clause(clause_re, soql_query, pos=0):
+    """返回第一个不在字符串字面量或括号内的子句关键字匹配"""
+    for match in clause_re.finditer(soql_query, pos):
+        if match.group('clause'):
+            return match
+    return None
+
+
+@dataclass(frozen=True)
+class PreparedSOQL:
+    """
+    解析一次的SOQL查询，记录各子句的位置，count/keyset/bulk/arrow等查询路径直接按位置切片
+
+    通过_prepare_soql构建（按查询字符串缓存），不要直接实例化。
+    """
+    raw: str
+    from_idx: int
+    where_idx: Optional[int]
+    condition_end_idx: int
+    order_by_idx: Optional[int]
+    count_end_idx: int
+    fields_idx: int
+    fields: Tuple[str, ...]
+    sobject: str
+
+    @property
+    def count_query(self):
+        """SELECT COUNT()查询，去掉ORDER BY, LIMIT, OFFSET, GROUP BY, HAVING"""
+        return f"SELECT COUNT() {self.raw[self.from_idx:self.count_end_idx].rstrip()}"
+
+    def with_id(self):
+        """keyset分页依赖Id，返回(确保SELECT了Id的查询, Id是否为新增字段)"""
+        if 'id' in (field.lower() for field in self.fields):
+            return self, False
+        return _prepare_soql(f"{self.raw[:self.fields_idx]}Id, {self.raw[self.fields_idx:]}"), True
+
+    def keyset_queries(self, batch_size):
+        """
+        返回(首批查询, 分批查询前缀, 分批查询后缀)
+
+        首批查询为 ... ORDER BY Id（不加LIMIT），之后每批只需拼接
+        f"{prefix}{last_id}{suffix}" 即 ... WHERE Id > 'last_id' [WITH ...] ORDER BY Id LIMIT batch_size
+
+        WITH子句保留在Id条件之后，原有ORDER BY被替换；GROUP BY, HAVING, LIMIT, OFFSET, FOR, UPDATE
+        无法和按Id分批组合，抛出ValueError。
+        """
+        unsupported = _search_clause(_KEYSET_UNSUPPORTED_RE, self.raw, self.condition_end_idx)
+        if unsupported is not None:
+            clause = ' '.join(unsupported.group('clause').upper().split())
+            raise ValueError(f"{clause} clause is not supported in batch queries")
+
+        base_query = self.raw[:self.condition_end_idx].rstrip()
+        with_clause = self.raw[self.condition_end_idx:self.order_by_idx].strip()
+        with_clause = f" {with_clause}" if with_clause else ""
+        if self.where_idx is not None:
+            condition = base_query[self.where_idx:].strip()
+            prefix = f"{base_query[:self.where_idx]} ({condition}) AND Id > '"
+        else:
+            prefix = f"{base_query} WHERE Id > '"
+        return (f"{base_query}{with_clause} ORDER BY Id", prefix,
+                f"'{with_clause} ORDER BY Id LIMIT {batch_size}")
+
+    def projected_fields(self):
+        """SELECT列表中的字段名，只支持普通字段和关系字段(如Account.Name)"""
+        for field in self.fields:
+            if not _FIELD_NAME_RE.match(field):
+                raise ValueError(f"Unsupported field in SELECT list: {field}")
+        return self.fields
+
+
+@functools.lru_cache(maxsize=64)
+def _prepare_soql(soql_query):
+    """解析SOQL查询；各子句关键字只在字符串字面量和括号（子查询）之外匹配"""
+    select_match = _SELECT_KEYWORD_RE.match(soql_query)
+    from_match = _search_clause(_FROM_RE, soql_query)
+    sobject_match = _SOBJECT_RE.match(soql_query, from_match.end()) if from_match else None
+    if select_match is None or sobject_match is None:
+        raise ValueError("Invalid SOQL query format")
+
+    count_end = _search_clause(_COUNT_STRIP_RE, soql_query, from_match.end())
+    order_by = _search_clause(_ORDER_BY_RE, soql_query, from_match.end())
+    where = _search_clause(_WHERE_RE, soql_query, from_match.end())
+    condition_end = _search_clause(_CONDITION_END_RE, soql_query, from_match.end())
+    if where is not None and condition_end is not None and where.start() > condition_end.start():
+        where = None
+
+    fields_idx = select_match.end()
+    fields = []
+    field_start = fields_idx
+    field_end = from_match.start()
+    separator = _search_clause(_FIELD_SEPARATOR_RE, soql_query, field_start)
+    while separator is not None and separator.start() < field_end:
+        fields.append(soql_query[field_start:separator.start()].strip())
+        field_start = separator.end()
+        separator = _search_clause(_FIELD_SEPARATOR_RE, soql_query, field_start)
+    fields.append(soql_query[field_start:field_end].strip())
+
+    return PreparedSOQL(
+        raw=soql_query,
+        from_idx=from_match.start(),
+        where_idx=where.end() if where else None,
+        condition_end_idx=condition_end.start() if condition_end else len(soql_query),
+        order_by_idx=order_by.start() if order_by else None,
+        count_end_idx=count_end.start() if count_end else len(soql_query),
+        fields_idx=fields_idx,
+        fields=tuple(fields),
+        sobject=sobject_match.group('sobject'),
+    )
+
+
+def _resolve_path(records, path):
+    """
+    SOQL字段名不区分大小写，按记录中的实际键名返回字段路径
+
+    关系对象在所有记录中都为空时，无法确定的部分保持原样（取值结果总是None）。
+    """
+    best = ()
+    for record in records:
+        value = record
+        resolved = []
+        for key in path:
+            if value is None:
+                break
+            if key not in value:
+                lowered = key.lower()
+                key = next((candidate for candidate in value if candidate.lower() == lowered), key)
+            resolved.append(key)
+            value = value.get(key)
+        if len(resolved) == len(path):
+            return tuple(resolved)
+        if len(resolved) > len(best):
+            best = tuple(resolved)
+    return best + tuple(path[len(best):])
+
+
+@functools.lru_cache(maxsize=64)
+def _record_projector(paths):
+    """
+    为给定的字段路径生成 record -> tuple 的专用函数
+
+    例如 (('Id',), ('Account', 'Name')) 生成
+    def project(r): return (r['Id'], (r['Account'] or _EMPTY).get('Name'),)
+    每个字段只需一次下标取值，没有逐字段的通用循环；键名经repr转义后才拼入源码。
+    """
+    expressions = []
+    for path in paths:
+        expression = f"r[{path[0]!r}]"
+        for key in path[1:]:
+            expression = f"({expression} or _EMPTY).get({key!r})"
+        expressions.append(expression)
+    source = f"def project(r):\n    return ({', '.join(expressions)},)\n"
+    namespace = {'_EMPTY': {}}
+    exec(source, namespace)
+    return namespace['project']
+
+
+def _strip_attributes(records):
+    """原地移除每条记录的attributes字段并返回同一个列表（map在C层循环，不逐条执行Python字节码）"""
+    deque(map(_POP_ATTRIBUTES, records), maxlen=0)
+    return records
+
+
 class SalesforceConnector:
-    def __init__(self,credential_secret):
+    def __init__(self,credential_secret, http2=False):
+        """
+        Args:
+            credential_secret: AWS Secrets Manager中保存Salesforce登录信息的secret名称
+            http2: 为True时REST请求改用httpx的HTTP/2连接（需要安装httpx[http2]）
+        """
         self.sf = None
         self.credential_secret = credential_secret
+        self.http2 = http2
+        self._login_time = None
+        self._reconnect_lock = threading.Lock()
+
+    def _ensure_connected(self):
+        if self.sf is None or time.monotonic() - self._login_time > _SESSION_TTL:
+            self.connect()
+
+    def _sf_call(self, method_name, *args, **kwargs):
+        """调用self.sf上的单个请求；会话过期时重新登录，只重试这一个请求"""
+        sf = self.sf
+        try:
+            return getattr(sf, method_name)(*args, **kwargs)
+        except SalesforceExpiredSession:
+            logger.warning("Salesforce session expired, reconnecting...")
+            with self._reconnect_lock:
+                # 预取线程可能同时遇到过期，只重新登录一次
+                if self.sf is sf:
+                    self.connect(force=True)
+            return getattr(self.sf, method_name)(*args, **kwargs)
+
+    def connect(self, force=False):
+        cached = _SF_CONNECTIONS.get((self.credential_secret, self.http2))
+        if not force and cached is not None and time.monotonic() - cached[1] <= _SESSION_TTL:
+            self.sf, self._login_time = cached
+            return
 
-    def connect(self):
         try:
             sm = SecretManager()
             sf_credential = sm.get_secret(self.credential_secret)
@@ -20,13 +367,21 @@ class SalesforceConnector:
                 'security_token': sf_credential.get('security_token'),
                 'domain': sf_credential.get('domain')  # 'login' 或者 'test'
             }
-            self.sf = Salesforce(**connection_params)
+            self.sf = _SalesforceClient(**connection_params)
+            if self.http2:
+                if httpx is None:
+                    raise ImportError("http2=True requires httpx: pip install httpx[http2]")
+                self.sf.session.mount('https://', _HttpxAdapter())
+            else:
+                _configure_http_session(self.sf.session)
+            self._login_time = time.monotonic()
+            _SF_CONNECTIONS[(self.credential_secret, self.http2)] = (self.sf, self._login_time)
             logger.info(f"Connect Successful！API Version: {self.sf.sf_version}")
         except Exception as e:
             logger.error(e)
             raise
 
-    def query_data(self, soql_query, paginate=True, batch_callback=None):
+    def query_data(self, soql_query, paginate=True, batch_callback=None, prefetch_pages=1, stream=False):
         """
         处理SOQL查询
 
@@ -35,12 +390,19 @@ class SalesforceConnector:
             paginate: 获取全部记录还是分页获取，大数据量推荐分页获取
             batch_callback: 可选的回调函数，用于处理每个批次的数据
                            callback(batch_records, batch_num, total_batches)
+            prefetch_pages: 分页获取时最多同时预取的页数，默认1表示逐页串行获取
+            stream: 为True时返回逐条产出记录的迭代器（见iter_query），内存只保留当前批次；
+                    流式读取总是分页获取，不能与paginate=False同时使用
 
         Returns:
-            list: 所有记录的列表
+            list: 所有记录的列表，stream=True时为记录迭代器
         """
-        if not self.sf:
-            self.connect()
+        if stream:
+            if not paginate:
+                raise ValueError("stream=True requires paginate=True")
+            return self.iter_query(soql_query, batch_callback, prefetch_pages)
+
+        self._ensure_connected()
 
         try:
             logger.info(f"Executing SOQL Query: {soql_query[:100]}...")
@@ -50,7 +412,7 @@ class SalesforceConnector:
                 return self._query_all_data(soql_query)
             else:
                 # 方法2: 使用query + query_more手动分页
-                return self._query_with_pagination(soql_query, batch_callback)
+                return self._query_with_pagination(soql_query, batch_callback, prefetch_pages)
 
         except Exception as e:
             logger.error(f"Query Failed: {str(e)}")
@@ -61,68 +423,162 @@ class SalesforceConnector:
         logger.info("Fetching all records...")
 
         # 执行query_all，它会自动处理所有分页
-        result = self.sf.query_all(soql_query)
+        result = self._sf_call('query_all', soql_query)
 
         # 获取总记录数
         total_size = result.get('totalSize', 0)
         logger.info(f"Total records found: {total_size}")
 
         # 处理记录（移除attributes字段）
-        records = []
-        for record in result['records']:
-            record.pop('attributes', None)
-            records.append(record)
+        records = _strip_attributes(result['records'])
 
         logger.info(f"Successfully retrieved {len(records)} records")
         return records
 
-    def _query_with_pagination(self, soql_query, batch_callback=None):
+    def iter_query(self, soql_query, batch_callback=None, prefetch_pages=1):
+        """
+        以生成器方式逐条返回查询结果，适合千万级数据的流式处理
+
+        Args:
+            soql_query: SOQL查询语句
+            batch_callback: 可选的回调函数 callback(batch_records, batch_num, total_size)
+            prefetch_pages: 最多同时预取的页数，默认1表示逐页串行获取
+
+        Yields:
+            dict: 单条记录
+        """
+        self._ensure_connected()
+        logger.info(f"Executing SOQL Query: {soql_query[:100]}...")
+
+        try:
+            for batch_records in self._iter_paginated_batches(soql_query, batch_callback, prefetch_pages):
+                yield from batch_records
+        except Exception as e:
+            logger.error(f"Query Failed: {str(e)}")
+            raise
+
+    def _query_with_pagination(self, soql_query, batch_callback=None, prefetch_pages=1):
         """使用分页获取所有数据"""
+        all_records = []
+        for batch_records in self._iter_paginated_batches(soql_query, batch_callback, prefetch_pages):
+            # 添加到总记录列表
+            all_records.extend(batch_records)
+        return all_records
+
+    def _iter_paginated_batches(self, soql_query, batch_callback=None, prefetch_pages=1):
+        """使用分页逐批返回数据"""
         logger.info("Using pagination to fetch records...")
 
-        all_records = []
         batch_num = 0
+        total_size = 0
+        retrieved = 0
 
-        # 获取第一页数据
-        result = self.sf.query(soql_query)
-        total_size = result.get('totalSize', 0)
-        logger.info(f"Total records found: {total_size}")
-
-        while True:
+        for result in self._iter_pages(soql_query, prefetch_pages):
             batch_num += 1
-            batch_records = []
+            if batch_num == 1:
+                total_size = result.get('totalSize', 0)
+                logger.info(f"Total records found: {total_size}")
 
             # 处理当前批次的记录
-            for record in result['records']:
-                record.pop('attributes', None)
-                batch_records.append(record)
-
-            # 添加到总记录列表
-            all_records.extend(batch_records)
+            batch_records = _strip_attributes(result['records'])
+            retrieved += len(batch_records)
 
             # 如果有回调函数，处理当前批次
             if batch_callback:
                 try:
                     batch_callback(batch_records, batch_num, total_size)
                 except Exception as e:
-                    logger.warning(f"Batch callback failed: {e}")
+                    logger.warning("Batch callback failed: %s", e)
 
-            logger.info(f"Batch {batch_num}: Retrieved {len(batch_records)} records "
-                        f"(Total: {len(all_records)}/{total_size})")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Batch %d: Retrieved %d records (Total: %d/%d)",
+                            batch_num, len(batch_records), retrieved, total_size)
+            yield batch_records
 
-            # 检查是否还有更多数据
-            if result.get('done', True):
-                break
+        logger.info(f"Successfully retrieved {retrieved} records in {batch_num} batches")
 
-            # 获取下一页数据
+    def _iter_pages(self, soql_query, prefetch_pages=1):
+        """按顺序逐页返回query/query_more的结果，prefetch_pages大于1时预取后续页"""
+        # 获取第一页数据
+        result = self._sf_call('query', soql_query)
+        yield result
+
+        if prefetch_pages > 1:
+            result = yield from self._iter_prefetched_pages(result, prefetch_pages)
+            if result is None:
+                return
+
+        yield from self._iter_following_pages(result)
+
+    def _iter_following_pages(self, result):
+        """从result的nextRecordsUrl开始逐页获取"""
+        previous_url = None
+        while not result.get('done', True):
+            # done=False但缺少或重复返回nextRecordsUrl时停止，避免反复处理同一页
+            next_url = result.get('nextRecordsUrl')
+            if not next_url or next_url == previous_url:
+                logger.warning("Query is not done but nextRecordsUrl is %s, stop paging",
+                               'missing' if not next_url else f'unchanged ({next_url})')
+                return
+            previous_url = next_url
             try:
-                result = self.sf.query_more(result['nextRecordsUrl'], identifier_is_url=True)
+                result = self._sf_call('query_more', next_url, identifier_is_url=True)
             except Exception as e:
-                logger.error(f"Failed to fetch next page: {e}")
-                break
+                logger.error("Failed to fetch next page: %s", e)
+                return
+            yield result
 
-        logger.info(f"Successfully retrieved {len(all_records)} records in {batch_num} batches")
-        return all_records
+    def _iter_prefetched_pages(self, result, prefetch_pages):
+        """
+        假设页大小固定，预取result之后的页，返回最后一页供_iter_following_pages继续；获取失败时返回None
+
+        nextRecordsUrl形如 /services/data/vXX.X/query/<locator>-<offset>，后续每页的地址按第一页的
+        offset推算。Salesforce不保证页大小固定（字段多的查询每页更少），因此每页都核对记录数和
+        nextRecordsUrl，与推算不一致时丢弃其余预取，从服务端返回的nextRecordsUrl逐页继续。
+        """
+        locator = _LOCATOR_RE.match(result.get('nextRecordsUrl') or '')
+        if result.get('done', True) or locator is None:
+            return result
+
+        total_size = result.get('totalSize', 0)
+        page_size = int(locator.group('offset'))
+        page_offsets = iter(range(page_size, total_size, page_size))
+
+        def page_url(offset):
+            return f"{locator.group('prefix')}{offset}"
+
+        with ThreadPoolExecutor(max_workers=prefetch_pages) as executor:
+            pending = deque((offset, executor.submit(self._sf_call, 'query_more', page_url(offset),
+                                                     identifier_is_url=True))
+                            for offset in itertools.islice(page_offsets, prefetch_pages))
+            while pending:
+                offset, future = pending.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("Failed to fetch next page: %s", e)
+                    for _, future in pending:
+                        future.cancel()
+                    return None
+
+                # 按offset获取的页，记录本身总是从offset开始，可以直接返回
+                yield result
+
+                next_offset = offset + page_size
+                expected_next_url = page_url(next_offset) if next_offset < total_size else None
+                if (len(result['records']) != min(page_size, total_size - offset)
+                        or result.get('nextRecordsUrl') != expected_next_url):
+                    logger.warning("Page at offset %d does not match the expected page size %d, "
+                                   "continue paging serially", offset, page_size)
+                    for _, future in pending:
+                        future.cancel()
+                    return result
+
+                next_offset = next(page_offsets, None)
+                if next_offset is not None:
+                    pending.append((next_offset, executor.submit(self._sf_call, 'query_more', page_url(next_offset),
+                                                                 identifier_is_url=True)))
+        return result
 
     def query_count(self, soql_query):
         """
@@ -134,100 +590,220 @@ class SalesforceConnector:
         Returns:
             int: 记录总数
         """
-        if not self.sf:
-            self.connect()
+        self._ensure_connected()
 
         try:
             # 修改查询为COUNT查询
-            if 'SELECT' in soql_query.upper() and 'FROM' in soql_query.upper():
-                # 提取FROM之后的部分
-                from_index = soql_query.upper().find('FROM')
-                count_query = f"SELECT COUNT() {soql_query[from_index:]}"
-
-                # 移除可能存在的ORDER BY, LIMIT, OFFSET等
-                for clause in ['ORDER BY', 'LIMIT', 'OFFSET', 'GROUP BY', 'HAVING']:
-                    if clause in count_query.upper():
-                        clause_index = count_query.upper().find(clause)
-                        count_query = count_query[:clause_index]
-
-                logger.info(f"Count query: {count_query}")
-                result = self.sf.query(count_query)
-                total_size = result.get('totalSize', 0)
-                logger.info(f"Total records: {total_size}")
-                return total_size
-            else:
-                raise ValueError("Invalid SOQL query format")
+            count_query = _prepare_soql(soql_query).count_query
+
+            logger.info(f"Count query: {count_query}")
+            result = self._sf_call('query', count_query)
+            total_size = result.get('totalSize', 0)
+            logger.info(f"Total records: {total_size}")
+            return total_size
 
         except Exception as e:
             logger.error(f"Count query failed: {str(e)}")
             raise
 
-    def query_in_batches(self, soql_query, batch_size=2000, batch_callback=None):
+    def query_in_batches(self, soql_query, batch_size=2000, batch_callback=None, stream=False):
         """
         分批查询数据，适合超大数据集
 
         Args:
-            soql_query: 基础SOQL查询（不应包含LIMIT和OFFSET）
+            soql_query: 基础SOQL查询（不能包含GROUP BY, HAVING, LIMIT, OFFSET，ORDER BY会被替换为ORDER BY Id）
             batch_size: 每批大小（默认2000）
             batch_callback: 回调函数 callback(batch_records, batch_num, total_batches)
+            stream: 为True时返回逐条产出记录的迭代器，内存只保留当前批次
 
         Returns:
-            list: 所有记录的列表
+            list: 所有记录的列表，stream=True时为记录迭代器
         """
-        if not self.sf:
-            self.connect()
+        self._ensure_connected()
+
+        batches = self._iter_keyset_batches(soql_query, batch_size, batch_callback)
+        if stream:
+            return itertools.chain.from_iterable(batches)
+
+        all_records = []
+        for batch_records in batches:
+            # 添加到总记录
+            all_records.extend(batch_records)
+        return all_records
 
-        # 首先获取总记录数
-        total_records = self.query_count(soql_query)
+    def _iter_keyset_batches(self, soql_query, batch_size, batch_callback=None):
+        """按Id逐批返回数据"""
+        # 按Id做keyset分页：OFFSET最大只支持2000，且每批都要服务端重新扫描跳过前面的行
+        prepared = _prepare_soql(soql_query)
+        if prepared.order_by_idx is not None:
+            logger.warning("ORDER BY is replaced by ORDER BY Id in batch queries")
+        prepared, id_added = prepared.with_id()
+        first_query, batch_prefix, batch_suffix = prepared.keyset_queries(batch_size)
+
+        # 第一批用不带LIMIT的query：响应里同时有totalSize和第一页数据，省掉一次COUNT()查询；
+        # 服务端分页大小按batch_size设置（允许200-2000），避免下载之后又被Id > 批次重复获取的行
+        query_options = {'Sforce-Query-Options': f'batchSize={max(200, min(batch_size, 2000))}'}
+        result = self._sf_call('query', first_query, headers=query_options)
+        total_records = result.get('totalSize', 0)
 
         if total_records == 0:
             logger.info("No records found")
-            return []
+            return
 
-        all_records = []
+        retrieved = 0
         total_batches = (total_records + batch_size - 1) // batch_size
 
         logger.info(f"Fetching {total_records} records in {total_batches} batches "
                     f"(batch size: {batch_size})")
 
-        for batch_num in range(total_batches):
-            offset = batch_num * batch_size
+        # 服务端分页可能小于batch_size，用query_more把第一批补满，保证各批大小与total_batches一致
+        records = list(result['records'])
+        while len(records) < batch_size and not result.get('done', True):
+            result = self._sf_call('query_more', result['nextRecordsUrl'], identifier_is_url=True)
+            records.extend(result['records'])
+        batch_records = _strip_attributes(records[:batch_size])
+        last_batch = result.get('done', True) and len(records) <= batch_size
+        batch_num = 0
+        next_batch = None
+
+        # keyset分页的各批次之间依赖上一批的最后一个Id，无法同时发出；
+        # 拿到Id后立即在后台线程获取下一批，与当前批次的回调/下游处理重叠
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                batch_num += 1
+
+                if next_batch is not None:
+                    result = next_batch.result()
+                    batch_records = _strip_attributes(result['records'])
+                    # 如果获取的记录少于batch_size，说明是最后一页
+                    last_batch = len(batch_records) < batch_size
+
+                # 上一批恰好取完全部记录
+                if not batch_records:
+                    break
+
+                last_id = batch_records[-1]['Id']
+                if not last_batch:
+                    # 构建分页查询
+                    batch_query = f"{batch_prefix}{last_id}{batch_suffix}"
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("Batch %d/%d: after Id %s", batch_num + 1, total_batches, last_id)
+                    next_batch = executor.submit(self._sf_call, 'query_all', batch_query)
+
+                if id_added:
+                    for record in batch_records:
+                        record.pop('Id', None)
+
+                retrieved += len(batch_records)
+
+                # 执行回调
+                if batch_callback:
+                    try:
+                        batch_callback(batch_records, batch_num, total_batches)
+                    except Exception as e:
+                        logger.warning("Batch callback failed: %s", e)
+
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Batch %d complete: %d records", batch_num, len(batch_records))
+                yield batch_records
+
+                if last_batch:
+                    break
+
+        logger.info(f"All batches complete. Total records: {retrieved}")
+
+    @_reauth_on_expired_session
+    def query_bulk(self, soql_query, max_records=50000, as_arrow=False):
+        """
+        使用Bulk API 2.0查询，适合几十万行以上的大数据量导出
 
-            # 构建分页查询
-            if 'ORDER BY' in soql_query.upper():
-                # 如果已有ORDER BY，在它之前添加LIMIT和OFFSET
-                order_by_index = soql_query.upper().find('ORDER BY')
-                batch_query = (f"{soql_query[:order_by_index]} "
-                               f"LIMIT {batch_size} OFFSET {offset} "
-                               f"{soql_query[order_by_index:]}")
-            else:
-                batch_query = f"{soql_query} LIMIT {batch_size} OFFSET {offset}"
+        结果以CSV分页返回（每页最多max_records行），比query/query_more每次往返的行数多得多。
 
-            logger.info(f"Batch {batch_num + 1}/{total_batches}: offset {offset}")
+        Args:
+            soql_query: SOQL查询语句
+            max_records: 每个结果页的最大行数
+            as_arrow: 为True时直接把CSV解析为pyarrow.Table（需要安装pyarrow）
 
-            # 执行查询
-            result = self.sf.query_all(batch_query)
-            batch_records = []
+        Returns:
+            list: 所有记录的列表（字段值均为字符串，空值为''），as_arrow=True时为pyarrow.Table
+        """
+        self._ensure_connected()
 
-            for record in result['records']:
-                record.pop('attributes', None)
-                batch_records.append(record)
+        bulk_object = getattr(self.sf.bulk2, _prepare_soql(soql_query).sobject)
 
-            # 添加到总记录
-            all_records.extend(batch_records)
+        logger.info(f"Executing Bulk API 2.0 Query: {soql_query[:100]}...")
 
-            # 执行回调
-            if batch_callback:
-                try:
-                    batch_callback(batch_records, batch_num + 1, total_batches)
-                except Exception as e:
-                    logger.warning(f"Batch callback failed: {e}")
+        if as_arrow:
+            import pyarrow as pa
+            import pyarrow.csv as pa_csv
 
-            logger.info(f"Batch {batch_num + 1} complete: {len(batch_records)} records")
+        records = []
+        tables = []
+        page_num = 0
+        try:
+            for page in bulk_object.query(soql_query, max_records=max_records):
+                # 没有结果时Bulk API可能返回空页（连表头都没有）
+                if not page.strip():
+                    continue
+                page_num += 1
+                if as_arrow:
+                    # Bulk API的CSV不带类型信息，统一按字符串读取，保证各页schema一致
+                    header = next(csv.reader(io.StringIO(page)))
+                    convert_options = pa_csv.ConvertOptions(
+                        column_types={name: pa.string() for name in header},
+                        strings_can_be_null=True)
+                    table = pa_csv.read_csv(io.BytesIO(page.encode('utf-8')),
+                                            convert_options=convert_options)
+                    tables.append(table)
+                    page_rows = table.num_rows
+                else:
+                    page_records = list(csv.DictReader(io.StringIO(page)))
+                    records.extend(page_records)
+                    page_rows = len(page_records)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Bulk page %d: Retrieved %d records", page_num, page_rows)
+        except Exception as e:
+            logger.error(f"Bulk query failed: {str(e)}")
+            raise
 
-            # 如果获取的记录少于batch_size，说明是最后一页
-            if len(batch_records) < batch_size:
-                break
+        if as_arrow:
+            if not tables:
+                return pa.table({})
+            table = pa.concat_tables(tables)
+            logger.info(f"Successfully retrieved {table.num_rows} records in {page_num} pages")
+            return table
+
+        logger.info(f"Successfully retrieved {len(records)} records in {page_num} pages")
+        return records
+
+    def query_data_arrow(self, soql_query, prefetch_pages=1):
+        """
+        分页查询并按列组装为pyarrow.Table（需要安装pyarrow），
+        避免每条记录一个dict的内存开销，便于直接转换为Spark DataFrame
+
+        Args:
+            soql_query: SOQL查询语句，SELECT列表只能包含普通字段和关系字段(如Account.Name)
+            prefetch_pages: 最多同时预取的页数，默认1表示逐页串行获取
+
+        Returns:
+            pyarrow.Table: 列名与SELECT列表中的字段一致
+        """
+        import pyarrow as pa
+
+        self._ensure_connected()
+
+        fields = _prepare_soql(soql_query).projected_fields()
+        paths = [field.split('.') for field in fields]
+        columns = [[] for _ in fields]
+
+        logger.info(f"Executing SOQL Query: {soql_query[:100]}...")
+
+        for batch_records in self._iter_paginated_batches(soql_query, prefetch_pages=prefetch_pages):
+            if not batch_records:
+                continue
+            project = _record_projector(tuple(_resolve_path(batch_records, path) for path in paths))
+            # 每条记录投影为tuple，再按列转置追加
+            for column, values in zip(columns, zip(*map(project, batch_records))):
+                column.extend(values)
 
-        logger.info(f"All batches complete. Total records: {len(all_records)}")
-        return all_records
\ No newline at end of file
+        return pa.Table.from_arrays([pa.array(column) for column in columns], names=list(fields))